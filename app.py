@@ -1,6 +1,14 @@
+import asyncio
+import os
+import ssl
+import threading
+from collections import deque
+
+import certifi
+import httpx
 import streamlit as st
-import google.generativeai as genai
-import time
+from google import genai
+from google.genai import errors, types
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -10,9 +18,12 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
+
 # --- CSS for Mobile Optimization ---
-st.markdown(
-    """
+@st.cache_data(show_spinner=False)
+def _css():
+    """Returns the app's custom stylesheet."""
+    return """
     <style>
     .main .block-container {
         padding-top: 1.5rem;
@@ -35,9 +46,10 @@ st.markdown(
         color: #ffffff;
     }
     </style>
-    """,
-    unsafe_allow_html=True,
-)
+    """
+
+
+st.markdown(_css(), unsafe_allow_html=True)
 
 # --- API Key Handling (Secrets Only) ---
 api_key = None
@@ -54,8 +66,35 @@ except (KeyError, FileNotFoundError):
     )
     st.stop()
 
+
+@st.cache_resource
+def _get_client(api_key: str):
+    """Returns the Gemini client shared by every session of the app.
+
+    Both transports speak HTTP/2, so concurrent requests are multiplexed
+    over one connection instead of opening one connection per call. An
+    explicit transport ignores the client's own SSL setup, so the context
+    honours SSL_CERT_FILE / SSL_CERT_DIR the same way google-genai does.
+    """
+    ssl_context = ssl.create_default_context(
+        cafile=os.environ.get("SSL_CERT_FILE", certifi.where()),
+        capath=os.environ.get("SSL_CERT_DIR"),
+    )
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            client_args={
+                "transport": httpx.HTTPTransport(http2=True, verify=ssl_context),
+            },
+            async_client_args={
+                "transport": httpx.AsyncHTTPTransport(http2=True, verify=ssl_context),
+            },
+        ),
+    )
+
+
 try:
-    genai.configure(api_key=api_key)
+    client = _get_client(api_key)
 except Exception as e:
     st.error(f"APIキーの設定に失敗しました: {e}")
     st.stop()
@@ -67,7 +106,11 @@ AVAILABLE_MODELS = {
     "Gemini 3 Flash (Preview)": "gemini-3-flash-preview",
 }
 AVAILABLE_MODEL_NAMES = list(AVAILABLE_MODELS.keys())
+MODEL_LABEL_TO_INDEX = {name: i for i, name in enumerate(AVAILABLE_MODEL_NAMES)}
 DEFAULT_MODEL_LABEL = "Gemini 2.5 Flash"
+PERSONA_CACHE_TTL = "3600s"
+RECENT_WINDOW = 20  # Messages rendered outside the "older" expander
+CONTEXT_WINDOW = 6  # Messages passed to the model as debate context
 
 DEFAULT_PERSONA_A = (
     "あなたは冷徹な論理学者です。\n"
@@ -83,25 +126,42 @@ DEFAULT_PERSONA_B = (
     "口調は穏やかで、落ち着いています。"
 )
 
-# --- Session State Initialization ---
-defaults = {
-    "page": "議論場",
-    "chat_history": [],
-    "is_debating": False,
-    "debate_finished": False,
-    "topic": "",
-    "persona_a_name": "論理学者",
-    "persona_a_text": DEFAULT_PERSONA_A,
-    "persona_a_model": DEFAULT_MODEL_LABEL,
-    "persona_b_name": "長老",
-    "persona_b_text": DEFAULT_PERSONA_B,
-    "persona_b_model": DEFAULT_MODEL_LABEL,
-    "max_rounds": 3,
-    "current_round_start": 0,
+# Default name, prompt and icon for each AI slot ("a" / "b")
+PERSONA_DEFAULTS = {
+    "a": {"name": "論理学者", "text": DEFAULT_PERSONA_A, "icon": "📐"},
+    "b": {"name": "長老", "text": DEFAULT_PERSONA_B, "icon": "🙏"},
 }
-for key, val in defaults.items():
-    if key not in st.session_state:
-        st.session_state[key] = val
+
+
+# --- Session State Initialization ---
+def _init_session_state():
+    """Fills in session defaults on a session's first run only."""
+    if st.session_state.get("_session_initialized"):
+        return
+
+    defaults = {
+        "page": "議論場",
+        "chat_history": [],
+        "context_window": deque(maxlen=CONTEXT_WINDOW),
+        "ai_turn_count": 0,
+        "is_debating": False,
+        "debate_finished": False,
+        "topic": "",
+        "max_rounds": 3,
+        "current_round_start": 0,
+    }
+    for persona_key, persona_default in PERSONA_DEFAULTS.items():
+        defaults[f"persona_{persona_key}_name"] = persona_default["name"]
+        defaults[f"persona_{persona_key}_text"] = persona_default["text"]
+        defaults[f"persona_{persona_key}_model"] = DEFAULT_MODEL_LABEL
+        defaults[f"persona_{persona_key}_cache"] = None
+    for key, val in defaults.items():
+        if key not in st.session_state:
+            st.session_state[key] = val
+    st.session_state._session_initialized = True
+
+
+_init_session_state()
 
 
 # --- Sidebar Navigation ---
@@ -128,32 +188,199 @@ with st.sidebar:
 
 
 # --- Helper Functions ---
-def generate_response(persona, model_label, history, prompt_text):
-    """Generates a response from the specific persona using Gemini."""
+@st.cache_resource
+def _get_event_loop():
+    """Returns an app-wide event loop running in a background thread.
+
+    Every session submits its async Gemini calls here, so the shared
+    client's connection pool lives on one loop and is reused across users.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    """Runs a coroutine on the shared event loop and waits for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result()
+
+
+def persona_config(persona, cache_name=None):
+    """Returns the generation config for a persona, preferring its context cache."""
+    if cache_name:
+        return types.GenerateContentConfig(cached_content=cache_name)
+    return types.GenerateContentConfig(system_instruction=persona)
+
+
+@st.cache_resource
+def _uncacheable_personas():
+    """Returns the app-wide set of (persona, model label) pairs Gemini refused to cache."""
+    return set()
+
+
+def create_persona_cache(persona, model_label):
+    """Uploads a persona as a Gemini context cache and returns its name.
+
+    Returns None when the persona cannot be cached; it is then sent as a
+    plain system instruction instead.
+    """
+    uncacheable = _uncacheable_personas()
+    if (persona, model_label) in uncacheable:
+        return None
     try:
-        model_id = AVAILABLE_MODELS[model_label]
-        model = genai.GenerativeModel(model_id)
-        
-        context_str = ""
-        for msg in history[-6:]:
-            name = msg.get("name", msg["role"])
-            context_str += f"{name}: {msg['content']}\n"
-        
-        full_prompt = f"""
-        {persona}
-        
-        これまでの議論の流れ:
-        {context_str}
-        
-        相手の直前の発言（あるいはテーマ）に対して、あなたの立場から短く簡潔（150文字程度）に反論または意見を述べてください。
-        直前の発言: {prompt_text}
-        """
+        cache = client.caches.create(
+            model=AVAILABLE_MODELS[model_label],
+            config=types.CreateCachedContentConfig(
+                system_instruction=persona,
+                ttl=PERSONA_CACHE_TTL,
+            ),
+        )
+        return cache.name
+    except errors.APIError as e:
+        if e.code == 400 and "min_total_token_count" in (e.message or ""):
+            # Below the model's minimum cacheable size; the same persona
+            # will be rejected again, so don't retry it for this model.
+            uncacheable.add((persona, model_label))
+        else:
+            st.toast(f"ペルソナのキャッシュ作成に失敗しました: {e}")
+        return None
 
-        response = model.generate_content(full_prompt)
-        return response.text
+
+def extend_persona_cache(cache_name):
+    """Pushes a persona cache's expiry out by PERSONA_CACHE_TTL.
+
+    Returns False if the cache no longer exists (e.g. it already expired).
+    """
+    try:
+        client.caches.update(
+            name=cache_name,
+            config=types.UpdateCachedContentConfig(ttl=PERSONA_CACHE_TTL),
+        )
+        return True
+    except errors.APIError:
+        return False
+
+
+def delete_persona_cache(cache_name):
+    """Deletes a persona context cache, ignoring ones that already expired."""
+    if not cache_name:
+        return
+    try:
+        client.caches.delete(name=cache_name)
+    except errors.APIError:
+        pass
+
+
+def ensure_persona_caches():
+    """Makes sure both personas have a live context cache for a debate segment.
+
+    An existing cache is kept and its TTL extended; a new one is only
+    created when there is none (never created, invalidated by a persona
+    save, or expired).
+    """
+    for persona_key in ("a", "b"):
+        cache_key = f"persona_{persona_key}_cache"
+        cache_name = st.session_state[cache_key]
+        if cache_name and extend_persona_cache(cache_name):
+            continue
+        st.session_state[cache_key] = create_persona_cache(
+            st.session_state[f"persona_{persona_key}_text"],
+            st.session_state[f"persona_{persona_key}_model"],
+        )
+
+
+def add_message(role, name, content):
+    """Appends a message to the chat history and the model's context window."""
+    st.session_state.chat_history.append({
+        "role": role,
+        "name": name,
+        "content": content,
+    })
+    st.session_state.context_window.append((name, content))
+    if role == "assistant":
+        st.session_state.ai_turn_count += 1
+
+
+def build_prompt(context, prompt_text):
+    """Builds the per-turn prompt from the recent context (persona excluded)."""
+    parts = [
+        "これまでの議論の流れ:",
+        *(f"{name}: {content}" for name, content in context),
+        "",
+        "相手の直前の発言（あるいはテーマ）に対して、あなたの立場から短く簡潔（150文字程度）に反論または意見を述べてください。",
+        f"直前の発言: {prompt_text}",
+    ]
+    return "\n".join(parts)
+
+
+def generate_response(persona, model_label, context, prompt_text, cache_name=None):
+    """Streams a response from the specific persona using Gemini, chunk by chunk."""
+    try:
+        full_prompt = build_prompt(context, prompt_text)
+
+        response = client.models.generate_content_stream(
+            model=AVAILABLE_MODELS[model_label],
+            contents=full_prompt,
+            config=persona_config(persona, cache_name),
+        )
+        has_text = False
+        for chunk in response:
+            if chunk.text:
+                has_text = True
+                yield chunk.text
+        if not has_text:
+            # Blocked or empty candidates stream no text at all
+            yield "（思考が中断されました）"
     except Exception as e:
         st.error(f"エラーが発生しました: {e}")
-        return "（思考が中断されました）"
+        yield "（思考が中断されました）"
+
+
+async def generate_responses_pair(
+    persona_a, model_label_a, persona_b, model_label_b, context, prompt_text,
+    cache_a=None, cache_b=None,
+):
+    """Generates both personas' responses to the same context concurrently.
+
+    Returns one entry per persona: the reply text, or the exception raised
+    by that request.
+    """
+    full_prompt = build_prompt(context, prompt_text)
+
+    results = await asyncio.gather(
+        client.aio.models.generate_content(
+            model=AVAILABLE_MODELS[model_label_a],
+            contents=full_prompt,
+            config=persona_config(persona_a, cache_a),
+        ),
+        client.aio.models.generate_content(
+            model=AVAILABLE_MODELS[model_label_b],
+            contents=full_prompt,
+            config=persona_config(persona_b, cache_b),
+        ),
+        return_exceptions=True,
+    )
+    texts = []
+    for result in results:
+        if not isinstance(result, Exception) and result.text is None:
+            # Blocked or empty candidates have no text; treat them as failures
+            result = ValueError("応答が空でした（ブロックされた可能性があります）")
+        texts.append(result if isinstance(result, Exception) else result.text)
+    return texts
+
+
+def render_message(msg):
+    """Renders one chat history entry with its speaker's avatar."""
+    avatar = "👤"
+    if msg.get("name") == st.session_state.persona_a_name:
+        avatar = PERSONA_DEFAULTS["a"]["icon"]
+    elif msg.get("name") == st.session_state.persona_b_name:
+        avatar = PERSONA_DEFAULTS["b"]["icon"]
+
+    with st.chat_message(msg["role"], avatar=avatar):
+        if "name" in msg:
+            st.write(f"**{msg['name']}**")
+        st.write(msg["content"])
 
 
 # ============================================================
@@ -178,32 +405,34 @@ def page_debate():
             if submitted and user_topic:
                 st.session_state.topic = user_topic
                 st.session_state.chat_history = []
-                st.session_state.chat_history.append({
-                    "role": "user",
-                    "name": "観客",
-                    "content": f"テーマ: 「{user_topic}」について議論してください。",
-                })
+                st.session_state.context_window.clear()
+                st.session_state.ai_turn_count = 0
+                add_message("user", "観客", f"テーマ: 「{user_topic}」について議論してください。")
                 st.session_state.is_debating = True
                 st.session_state.debate_finished = False
                 st.session_state.current_round_start = 0
+                ensure_persona_caches()
                 st.rerun()
 
-    # Display Chat History
-    for msg in st.session_state.chat_history:
-        avatar = "👤"
-        if msg.get("name") == st.session_state.persona_a_name:
-            avatar = "📐"
-        elif msg.get("name") == st.session_state.persona_b_name:
-            avatar = "🙏"
-        
-        with st.chat_message(msg["role"], avatar=avatar):
-            if "name" in msg:
-                st.write(f"**{msg['name']}**")
-            st.write(msg["content"])
+    # Display Chat History (older messages collapsed behind an expander)
+    history = st.session_state.chat_history
+    older, recent = history[:-RECENT_WINDOW], history[-RECENT_WINDOW:]
+    if older:
+        with st.expander(f"過去の発言を表示 ({len(older)}件)"):
+            for msg in older:
+                render_message(msg)
+    for msg in recent:
+        render_message(msg)
 
     # Auto-Debate Logic
     if st.session_state.is_debating:
-        # Stop button - checked before each API call (between turns)
+        # New messages are written above the progress status and stop button
+        chat_area = st.container()
+        status = st.status("議論進行中...", expanded=False)
+
+        # Stop button - pressing it interrupts the running debate loop below,
+        # and the resulting rerun lands here. Every finished turn is already
+        # in the history, so only the reply in progress is discarded.
         if st.button("🛑 議論を中断", use_container_width=True):
             st.session_state.is_debating = False
             st.session_state.debate_finished = True
@@ -212,39 +441,73 @@ def page_debate():
         # Count turns since the last debate start point
         turns_since_start = len(st.session_state.chat_history) - 1 - st.session_state.current_round_start
         max_turns = st.session_state.max_rounds * 2
-        
-        if turns_since_start < max_turns:
+
+        # Opening of a round: both AIs answer the same user message, so
+        # their requests are independent and can be dispatched together.
+        is_paired = (
+            st.session_state.chat_history[-1]["role"] == "user"
+            and st.session_state.ai_turn_count % 2 == 0
+            and max_turns - turns_since_start >= 2
+        )
+
+        if is_paired:
+            last_content = st.session_state.chat_history[-1]["content"]
+            status.update(
+                label=f"{st.session_state.persona_a_name}と{st.session_state.persona_b_name}が思考中... "
+                f"({st.session_state.persona_a_model} / {st.session_state.persona_b_model})"
+            )
+            try:
+                results = run_async(generate_responses_pair(
+                    st.session_state.persona_a_text, st.session_state.persona_a_model,
+                    st.session_state.persona_b_text, st.session_state.persona_b_model,
+                    st.session_state.context_window, last_content,
+                    st.session_state.persona_a_cache, st.session_state.persona_b_cache,
+                ))
+            except Exception as e:
+                results = [e, e]
+
+            texts = []
+            for result in results:
+                if isinstance(result, Exception):
+                    with chat_area:
+                        st.error(f"エラーが発生しました: {result}")
+                    result = "（思考が中断されました）"
+                texts.append(result)
+            text_a, text_b = texts
+            add_message("assistant", st.session_state.persona_a_name, text_a)
+            add_message("assistant", st.session_state.persona_b_name, text_b)
+            with chat_area:
+                render_message(st.session_state.chat_history[-2])
+                render_message(st.session_state.chat_history[-1])
+            turns_since_start += 2
+
+        # Play out the remaining turns within this single script run
+        while turns_since_start < max_turns:
             # Determine whose turn based on total AI turns (exclude user messages)
-            ai_messages = [m for m in st.session_state.chat_history if m["role"] == "assistant"]
-            ai_turn_count = len(ai_messages)
-            
-            if ai_turn_count % 2 == 0:
-                current_role_name = st.session_state.persona_a_name
-                current_persona = st.session_state.persona_a_text
-                current_model = st.session_state.persona_a_model
-            else:
-                current_role_name = st.session_state.persona_b_name
-                current_persona = st.session_state.persona_b_text
-                current_model = st.session_state.persona_b_model
-            
+            persona_key = "a" if st.session_state.ai_turn_count % 2 == 0 else "b"
+            current_role_name = st.session_state[f"persona_{persona_key}_name"]
+            current_persona = st.session_state[f"persona_{persona_key}_text"]
+            current_model = st.session_state[f"persona_{persona_key}_model"]
+            current_cache = st.session_state[f"persona_{persona_key}_cache"]
+            current_avatar = PERSONA_DEFAULTS[persona_key]["icon"]
+
             last_content = st.session_state.chat_history[-1]["content"]
+            status.update(label=f"{current_role_name}が思考中... ({current_model})")
 
-            with st.spinner(f"{current_role_name}が思考中... ({current_model})"):
-                time.sleep(1)
-                response_text = generate_response(
+            # Stream the reply into its chat bubble as tokens arrive
+            with chat_area, st.chat_message("assistant", avatar=current_avatar):
+                st.write(f"**{current_role_name}**")
+                response_text = st.write_stream(generate_response(
                     current_persona, current_model,
-                    st.session_state.chat_history, last_content
-                )
-                st.session_state.chat_history.append({
-                    "role": "assistant",
-                    "name": current_role_name,
-                    "content": response_text,
-                })
-                st.rerun()
-        else:
-            st.session_state.is_debating = False
-            st.session_state.debate_finished = True
-            st.rerun()
+                    st.session_state.context_window, last_content, current_cache
+                ))
+            add_message("assistant", current_role_name, response_text)
+
+            turns_since_start += 1
+
+        st.session_state.is_debating = False
+        st.session_state.debate_finished = True
+        st.rerun()
 
     # Post-Debate: User Participation
     if st.session_state.debate_finished and not st.session_state.is_debating:
@@ -269,18 +532,17 @@ def page_debate():
                 )
 
         if continue_debate and user_opinion:
-            st.session_state.chat_history.append({
-                "role": "user",
-                "name": "観客",
-                "content": user_opinion,
-            })
+            add_message("user", "観客", user_opinion)
             st.session_state.current_round_start = len(st.session_state.chat_history) - 1
             st.session_state.is_debating = True
             st.session_state.debate_finished = False
+            ensure_persona_caches()
             st.rerun()
         
         if new_topic:
             st.session_state.chat_history = []
+            st.session_state.context_window.clear()
+            st.session_state.ai_turn_count = 0
             st.session_state.topic = ""
             st.session_state.debate_finished = False
             st.session_state.current_round_start = 0
@@ -290,23 +552,27 @@ def page_debate():
 # ============================================================
 # Page: Persona Editing
 # ============================================================
+@st.cache_data(show_spinner=False, max_entries=16)
+def render_persona_html(name, text, icon, model):
+    """Builds the persona card HTML; keeps the most recent cards cached."""
+    return (
+        f'<div class="persona-card">'
+        f'<div class="persona-title">{icon} {name} （{model}）</div>'
+        f'{text.translate({10: "<br>"})}'
+        f'</div>'
+    )
+
+
 def page_persona(persona_key: str):
     """Render persona viewing/editing page."""
-    if persona_key == "a":
-        name_key = "persona_a_name"
-        text_key = "persona_a_text"
-        model_key = "persona_a_model"
-        default_text = DEFAULT_PERSONA_A
-        default_name = "論理学者"
-        icon = "📐"
-    else:
-        name_key = "persona_b_name"
-        text_key = "persona_b_text"
-        model_key = "persona_b_model"
-        default_text = DEFAULT_PERSONA_B
-        default_name = "長老"
-        icon = "🙏"
-    
+    name_key = f"persona_{persona_key}_name"
+    text_key = f"persona_{persona_key}_text"
+    model_key = f"persona_{persona_key}_model"
+    cache_key = f"persona_{persona_key}_cache"
+    default_text = PERSONA_DEFAULTS[persona_key]["text"]
+    default_name = PERSONA_DEFAULTS[persona_key]["name"]
+    icon = PERSONA_DEFAULTS[persona_key]["icon"]
+
     current_name = st.session_state[name_key]
     current_text = st.session_state[text_key]
     current_model = st.session_state[model_key]
@@ -316,10 +582,7 @@ def page_persona(persona_key: str):
     # Current persona display
     st.subheader("現在の性格")
     st.markdown(
-        f'<div class="persona-card">'
-        f'<div class="persona-title">{icon} {current_name} （{current_model}）</div>'
-        f'{current_text.replace(chr(10), "<br>")}'
-        f'</div>',
+        render_persona_html(current_name, current_text, icon, current_model),
         unsafe_allow_html=True,
     )
 
@@ -329,7 +592,7 @@ def page_persona(persona_key: str):
         new_name = st.text_input("AI の名前", value=current_name)
         
         # Model selection
-        current_model_index = AVAILABLE_MODEL_NAMES.index(current_model) if current_model in AVAILABLE_MODEL_NAMES else 0
+        current_model_index = MODEL_LABEL_TO_INDEX.get(current_model, 0)
         new_model = st.selectbox(
             "使用するモデル",
             options=AVAILABLE_MODEL_NAMES,
@@ -351,6 +614,8 @@ def page_persona(persona_key: str):
         st.session_state[name_key] = new_name
         st.session_state[text_key] = new_text
         st.session_state[model_key] = new_model
+        delete_persona_cache(st.session_state[cache_key])
+        st.session_state[cache_key] = None
         st.success(f"「{new_name}」の設定を保存しました！（モデル: {new_model}）")
         st.rerun()
     
@@ -358,6 +623,8 @@ def page_persona(persona_key: str):
         st.session_state[name_key] = default_name
         st.session_state[text_key] = default_text
         st.session_state[model_key] = DEFAULT_MODEL_LABEL
+        delete_persona_cache(st.session_state[cache_key])
+        st.session_state[cache_key] = None
         st.success("初期設定に戻しました。")
         st.rerun()
 